@@ -5,21 +5,99 @@ Routes queries to specialized 'Instruction Maps' to simulate multi-agent behavio
 using the core Gemini API for Tool Calling and Instruction adherence.
 """
 
+import io
 import os
+import re
+import sys
+import json
+import math
+import random
+import time
+import logging
 import asyncio
+import hashlib
+import weakref
+import functools
+from collections import Counter, OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TextIO
+import httpx
+from pydantic import BaseModel
 from google import genai
 from google.genai import types
 from google.genai.errors import APIError
 
-# --- 0. Client Setup (API Key is assumed to be set via 'export GEMINI_API_KEY') ---
+LOG = logging.getLogger("multi_agent_runner")
+
+# HTTP/2 support is optional; httpx needs the 'h2' package for it (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    _HAS_H2 = True
+except ImportError:
+    _HAS_H2 = False
+
+# orjson is optional; it parses the structured (JSON) responses several times faster
 try:
-    # Client will automatically pick up GEMINI_API_KEY from the environment
-    client = genai.Client()
-    print("Gemini Client initialized successfully.")
-except Exception as e:
-    print(f"\nFATAL: Error initializing Gemini Client. Ensure GEMINI_API_KEY is set correctly.\nError: {e}")
-    client = None
-    exit()
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
+
+def _json_loads(text: str):
+    return orjson.loads(text) if _HAS_ORJSON else json.loads(text)
+
+def _json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if _HAS_ORJSON else json.dumps(obj)
+
+# --- 0. Client Setup (API Key is assumed to be set via 'export GEMINI_API_KEY') ---
+# One long-lived connection pool is shared by every call, so TCP+TLS handshakes
+# are paid once instead of per request. With HTTP/2 all concurrent calls are
+# multiplexed over a single connection.
+# The async httpx client is built here and handed to the SDK: passing it in is what
+# makes the SDK use httpx (not aiohttp, which ignores these settings) for client.aio.
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0)
+# The SDK sends HttpOptions.timeout (milliseconds) with every request, overriding
+# the httpx client's own default, so this is the timeout that actually applies.
+_HTTP_TIMEOUT_MS = 600_000
+
+# The client is created on first use rather than at import, so importing this
+# module (for tests or tooling) stays cheap and never exits the interpreter.
+# An httpx connection pool is tied to the event loop it first ran on, so each
+# running loop gets its own client (and pool); on one persistent loop that is a
+# single shared client.
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[genai.Client, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+
+def get_client() -> genai.Client:
+    """Returns the Gemini client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(loop)
+    if entry is None:
+        async_http = httpx.AsyncClient(http2=_HAS_H2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT_MS / 1000)
+        # Client will automatically pick up GEMINI_API_KEY from the environment
+        client = genai.Client(
+            http_options=types.HttpOptions(
+                timeout=_HTTP_TIMEOUT_MS,
+                client_args={"http2": _HAS_H2, "limits": _HTTP_LIMITS},
+                httpx_async_client=async_http,
+            )
+        )
+        entry = _clients[loop] = (client, async_http)
+        LOG.info("Gemini Client initialized successfully.")
+    return entry[0]
+
+async def close_client():
+    """
+    Closes the running loop's client and its connection pool. Long-running callers
+    keep the client (and its open connections) across serve() calls and call this
+    once before their loop shuts down.
+    """
+    entry = _clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        client, async_http = entry
+        # The SDK leaves a caller-provided httpx client open, so close it here
+        await client.aio.aclose()
+        await async_http.aclose()
 
 # --- 1. Tool Definitions (Functional Tools for Gemini) ---
 # Note: google-genai uses built-in functions for tools like Code Execution and Search
@@ -43,6 +121,93 @@ def code_executor(code: str) -> str:
 # Define the tools list for the model's eyes
 TOOL_FUNCTIONS = [google_search, code_executor]
 
+# --- Rate Limiting & Retries ---
+# Caps the number of in-flight API calls when queries run concurrently. The cap
+# adapts AIMD-style: it grows by one after a streak of successful calls and halves
+# when the API answers 429, so bursts settle just below the rate limit. A burst of
+# 429s from calls that were already in flight counts as one event and cuts once.
+MAX_CONCURRENT_CALLS = 8
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+_RETRYABLE_CODES = frozenset({429, 500, 502, 503, 504})
+
+class AdaptiveLimiter:
+    """Bounds concurrent API calls with an AIMD-tuned limit (acquire/release slots)."""
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 32, streak: int = 8) -> None:
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.streak = streak
+        self._in_flight = 0
+        self._successes = 0
+        # Bumped on every cut; a slot remembers the epoch it was taken in
+        self._epoch = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> int:
+        """Waits for a free slot and returns its token for release()."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+            return self._epoch
+
+    async def release(self, token: int, exc: BaseException | None = None):
+        """Frees a slot; 'exc' is the error the call ended with, if any."""
+        async with self._cond:
+            self._in_flight -= 1
+            if exc is None:
+                self._successes += 1
+                if self._successes >= self.streak:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self._successes = 0
+            elif isinstance(exc, APIError) and exc.code == 429:
+                self._successes = 0
+                # Calls started before the last cut already belong to that event
+                if token == self._epoch:
+                    self._epoch += 1
+                    self.limit = max(self.minimum, self.limit // 2)
+                    LOG.warning("Rate limited; concurrency limit lowered to %d", self.limit)
+            self._cond.notify_all()
+
+# asyncio primitives belong to the loop that first waits on them, so each running
+# loop (e.g. successive asyncio.run(serve(...)) calls) gets its own limiter.
+_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AdaptiveLimiter]" = weakref.WeakKeyDictionary()
+
+def _get_limiter() -> AdaptiveLimiter:
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = AdaptiveLimiter(MAX_CONCURRENT_CALLS)
+    return limiter
+
+async def _call_with_retry(make_call, hold_slot: bool = False):
+    """
+    Awaits make_call() under the limiter, retrying transient API errors (429/5xx)
+    with jittered exponential backoff. Slots are released while backing off.
+    With hold_slot=True the slot stays taken after a successful call, for work that
+    continues past it (streams); (result, token) is returned and the caller must
+    then call _get_limiter().release(token).
+    """
+    limiter = _get_limiter()
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        token = await limiter.acquire()
+        try:
+            result = await make_call()
+        except BaseException as e:
+            await limiter.release(token, e)
+            if not isinstance(e, APIError) or e.code not in _RETRYABLE_CODES or attempt == RETRY_ATTEMPTS:
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)) + random.uniform(0, RETRY_BASE_DELAY)
+            LOG.warning("API call failed (%s); retrying in %.1fs (attempt %d/%d)", e.code, delay, attempt + 1, RETRY_ATTEMPTS)
+            await asyncio.sleep(delay)
+            continue
+        if hold_slot:
+            return result, token
+        await limiter.release(token)
+        return result
+
 # --- 2. Instruction Map (Mapping Agents to their detailed instructions) ---
 # This dictionary simulates the specialized 'Agents' and their instructions.
 INSTRUCTION_MAP = {
@@ -91,117 +256,581 @@ INSTRUCTION_MAP = {
     """,
 }
 
-# --- 3. The Main Router/Execution Function ---
+# Fixed for the lifetime of the process; shared by the router and the fused prompt.
+_AGENT_KEYS_TUPLE = tuple(INSTRUCTION_MAP.keys())
+_KEY_SET = frozenset(_AGENT_KEYS_TUPLE)
+
+# --- 3. The Local Router ---
+# Routing is a fixed 13-way classification, so it runs locally instead of costing
+# a Gemini round-trip: queries are scored by TF-IDF cosine similarity against the
+# agent instructions themselves. Ambiguous or multi-step queries go to PlannerAgent.
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOP_WORDS = frozenset(
+    "a an and are as at be by for from how in is it its of on or that the this to use using what with you your".split()
+    # Step markers decide multi-step routing (below), not the topic
+    + "first then afterwards after finally step steps".split()
+)
+# Queries whose best score is below this have no clear specialist.
+ROUTING_THRESHOLD = 0.15
+# A sequence of step markers ("First ..., and then ...") signals a multi-step request.
+# A single marker ("the first step", "Finally, ...") does not.
+_STEP_MARKER_RE = re.compile(r"\b(first|then|afterwards|after that|finally)\b", re.IGNORECASE)
+
+def _is_multi_step(query: str) -> bool:
+    return len(_STEP_MARKER_RE.findall(query)) >= 2
+
+# Crude suffix stripping, so inflections share a term ("secure"/"security"/"securely").
+# Otherwise a common word in one short instruction can outscore a specific one
+# ("SSH") in a longer instruction, purely by document length.
+_SUFFIXES = ("ities", "ity", "ies", "ing", "ed", "es", "e", "s")
+
+def _stem(word: str) -> str:
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+def _tokenize(text: str) -> list[str]:
+    return [_stem(w) for w in _TOKEN_RE.findall(text.lower()) if len(w) > 1 and w not in _STOP_WORDS]
+
+def _agent_document(key: str, instruction: str) -> str:
+    # The key's own words ("Veterinary KB", "Remote Access") are strong signals too
+    return re.sub(r"(?<!^)(?=[A-Z])", " ", key.removesuffix("Agent")) + " " + instruction
+
+def _build_agent_vectors() -> tuple[dict[str, float], dict[str, dict[str, float]]]:
+    """Fits IDF weights on the agent instructions and returns (idf, unit agent vectors)."""
+    counts = {key: Counter(_tokenize(_agent_document(key, instr))) for key, instr in INSTRUCTION_MAP.items()}
+    doc_freq = Counter(word for c in counts.values() for word in c)
+    n_docs = len(counts)
+    idf = {word: math.log((1 + n_docs) / (1 + df)) + 1 for word, df in doc_freq.items()}
+    return idf, {key: _tfidf_vector(c, idf) for key, c in counts.items()}
+
+def _tfidf_vector(counts: Counter, idf: dict[str, float]) -> dict[str, float]:
+    vec = {word: tf * idf[word] for word, tf in counts.items() if word in idf}
+    norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+    return {word: v / norm for word, v in vec.items()}
+
+_IDF, _AGENT_VECTORS = _build_agent_vectors()
+
+@functools.lru_cache(maxsize=1024)
+def _classify(query: str) -> str:
+    """Scores the query against every agent instruction locally (no API call)."""
+    if _is_multi_step(query):
+        return "PlannerAgent"
+    query_vec = _tfidf_vector(Counter(_tokenize(query)), _IDF)
+    best_key, best_score = "PlannerAgent", 0.0
+    for key, agent_vec in _AGENT_VECTORS.items():
+        score = sum(weight * agent_vec.get(word, 0.0) for word, weight in query_vec.items())
+        if score > best_score:
+            best_key, best_score = key, score
+    if best_score < ROUTING_THRESHOLD:
+        return "PlannerAgent"
+    return best_key
+
+# Routes picked by the model for queries the local classifier could not place
+# (best score under ROUTING_THRESHOLD) persist across runs, keyed by a hash of the
+# normalized query, so a repeated ambiguous query goes straight to its specialist
+# next time. Local classifications are cheap and never stored, and multi-step
+# queries always go to PlannerAgent regardless of the cache.
+# The file carries a fingerprint of everything routing depends on; a cache written
+# under different instructions, threshold or classifier is discarded on load.
+ROUTE_CACHE_PATH = Path.home() / ".cache" / "multi_agent" / "routes.json"
+# Least recently used routes beyond this are dropped when the cache is saved.
+ROUTE_CACHE_SIZE = 1024
+# Bump when the classifier logic changes so stale cached routes are dropped.
+ROUTER_VERSION = 4
+
+def _route_key(query: str) -> str:
+    return hashlib.blake2b(query.lower().strip().encode(), digest_size=16).hexdigest()
+
+def _router_fingerprint() -> str:
+    # Plain json with sorted keys: the fingerprint must not depend on whether orjson is installed
+    payload = json.dumps([ROUTER_VERSION, ROUTING_THRESHOLD, INSTRUCTION_MAP], sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+def _load_route_cache() -> OrderedDict[str, str]:
+    try:
+        data = _json_loads(ROUTE_CACHE_PATH.read_text())
+    except (OSError, ValueError):
+        return OrderedDict()
+    if not isinstance(data, dict) or data.get("fingerprint") != _router_fingerprint():
+        return OrderedDict()
+    routes = data.get("routes")
+    if not isinstance(routes, dict):
+        return OrderedDict()
+    # Drop malformed entries and agents that no longer exist; the file is saved oldest first
+    return OrderedDict((key, agent) for key, agent in routes.items() if isinstance(agent, str) and agent in _KEY_SET)
+
+# Loaded on first use (like the client) so importing the module never touches disk.
+_route_cache = None
+_route_cache_dirty = False
+
+def _get_route_cache() -> OrderedDict[str, str]:
+    global _route_cache
+    if _route_cache is None:
+        _route_cache = _load_route_cache()
+    return _route_cache
+
+def save_route_cache():
+    """Writes the routing cache to disk if it changed, so later runs can reuse it."""
+    global _route_cache_dirty
+    if not _route_cache_dirty:
+        return
+    while len(_route_cache) > ROUTE_CACHE_SIZE:
+        _route_cache.popitem(last=False)
+    try:
+        ROUTE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        ROUTE_CACHE_PATH.write_text(_json_dumps({"fingerprint": _router_fingerprint(), "routes": dict(_route_cache)}))
+    except OSError as e:
+        LOG.warning("Could not save routing cache: %s", e)
+        return
+    _route_cache_dirty = False
+
+def remember_route(query: str, agent_key: str):
+    """Records the agent the model chose for a query the local classifier could not place."""
+    global _route_cache_dirty
+    if _is_multi_step(query) or _classify(query) != "PlannerAgent":
+        return
+    routes = _get_route_cache()
+    key = _route_key(query)
+    if routes.get(key) != agent_key:
+        routes[key] = agent_key
+        _route_cache_dirty = True
+    routes.move_to_end(key)
 
 def determine_agent(query: str) -> str:
     """
     Determines the best specialized instruction key for the given query.
-    For simplicity, this function uses the model itself to decide the best route.
+    Multi-step queries always go to PlannerAgent. Otherwise the query is classified
+    locally, and an ambiguous one uses the model's earlier pick when one is cached.
     """
-    # Create a system prompt for the RootAgent/Router
-    router_prompt = f"""
-    You are the Root Agent. Your only task is to analyze the following user query 
-    and identify the single MOST appropriate specialized instruction key from the list below. 
-    If the query is complex or multi-step, choose 'PlannerAgent'. Otherwise, choose the 
-    most relevant specialist.
+    agent_key = _classify(query)
+    if agent_key != "PlannerAgent" or _is_multi_step(query):
+        return agent_key
+    routes = _get_route_cache()
+    key = _route_key(query)
+    cached = routes.get(key)
+    if cached is None:
+        return agent_key
+    routes.move_to_end(key)
+    return cached
 
-    Available Instruction Keys: {list(INSTRUCTION_MAP.keys())}
-    
-    Respond ONLY with the chosen Instruction Key (e.g., 'VeterinaryKBAgent').
-    Do not add any other text, explanation, or punctuation.
+# --- 4. The Execution Calls ---
+# Specialist queries run under their own instruction with the real tools.
+# PlannerAgent queries use one fused call: the model sees every agent instruction,
+# picks the best one and answers under it, returning structured JSON.
+
+# eq=False: routes compare and hash by identity, since tool_calls holds arg dicts
+@dataclass(slots=True, frozen=True, eq=False)
+class AgentRoute:
+    """Outcome of one query: where it was routed and what the agent answered."""
+    query: str
+    agent_key: str
+    tool_calls: tuple[tuple[str, dict], ...]
+    text: str
+    latency_ms: float
+
+def dump_routes(routes: list[AgentRoute]) -> str:
+    """Serializes routes to a JSON array."""
+    return _json_dumps([asdict(route) for route in routes])
+
+class ToolCallRequest(BaseModel):
+    """A tool invocation the model wants to make (args are JSON-encoded)."""
+    name: str
+    args: str
+
+class RoutedAnswer(BaseModel):
+    """Response schema for the fused routing + execution call."""
+    agent_key: str
+    answer: str
+    tool_calls: list[ToolCallRequest]
+
+class BatchAnswer(RoutedAnswer):
+    """One entry of the batched response; 'index' is the 1-based query number."""
+    index: int
+
+def build_router_prompt() -> str:
+    """Builds the Root Agent system prompt with every agent instruction inlined."""
+    sections = "\n".join(
+        f"### {key}\n{instruction.strip()}" for key, instruction in INSTRUCTION_MAP.items()
+    )
+    return f"""
+    You are the Root Agent. First identify the single MOST appropriate specialized 
+    instruction key for the user query from the list below, then answer the query 
+    strictly following that instruction. If the query is complex or multi-step, choose 
+    'PlannerAgent', decompose it and cover every step in your answer.
+
+    Available Instruction Keys: {_json_dumps(_AGENT_KEYS_TUPLE)}
+
+{sections}
+
+    Available tools: google_search(query: str), code_executor(code: str).
+    List every tool call the chosen instruction requires in 'tool_calls', with its 
+    arguments as a JSON object string in 'args'. Leave 'tool_calls' empty if none is needed.
+    Respond ONLY with JSON matching the response schema; 'agent_key' must be one of the keys above.
     """
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[router_prompt, f"User Query: {query}"],
-            config=types.GenerateContentConfig(
-                system_instruction="You are a routing expert. Follow the instructions strictly and output only the key.",
-                temperature=0.0 # Force deterministic output
-            )
-        )
-        # Clean the output to ensure we get a valid key
-        key = response.text.strip().replace("'", "").replace('"', '')
-        if key in INSTRUCTION_MAP:
-            return key
-        # Fallback if the model gives a bad answer
-        print(f"\n[Routing Fallback] Model returned invalid key: {key}")
-        return "PlannerAgent" 
 
-    except APIError as e:
-        print(f"\n[Routing Error] Failed to route query: {e}")
-        return "PlannerAgent"
+# Built once; the prompt only depends on INSTRUCTION_MAP.
+_ROUTER_PROMPT = build_router_prompt()
 
-async def call_agent_and_print(query: str):
-    """Sends a query to the model using the determined specialized instruction."""
-    
-    # 1. Determine the Agent (Route the query)
+# Each agent only gets the tools its instruction actually uses; every declared
+# tool adds its schema to the prompt. Agents not listed get google_search only.
+_TOOLS_FOR = {
+    "UrlContextAgent": [],
+    "CodingAgent": [code_executor],
+}
+
+# Request configs never change for a given agent, so build them once up front.
+# PlannerAgent has none: its queries always go through the fused router call.
+_CONFIGS = {
+    key: types.GenerateContentConfig(
+        tools=_TOOLS_FOR.get(key, [google_search]) or None,
+        system_instruction=instruction,
+    )
+    for key, instruction in INSTRUCTION_MAP.items()
+    if key != "PlannerAgent"
+}
+_MODEL_FOR = {
+    key: 'gemini-2.5-pro' if key == "CreativeAgent" else 'gemini-2.5-flash' # Use Pro for creative tasks
+    for key in _CONFIGS
+}
+_ROUTER_MODEL = 'gemini-2.5-flash'
+_ROUTER_CONFIG = types.GenerateContentConfig(
+    system_instruction=_ROUTER_PROMPT,
+    response_mime_type="application/json",
+    response_schema=RoutedAnswer,
+)
+_BATCH_CONFIG = types.GenerateContentConfig(
+    system_instruction=_ROUTER_PROMPT,
+    response_mime_type="application/json",
+    response_schema=list[BatchAnswer],
+)
+
+def _format_header(query: str, agent_key: str) -> str:
+    return (
+        f"\n[User Query] -> {query}\n"
+        f"[Agent Routed To] -> {agent_key}\n"
+        "----------------------\n"
+        "\n--- [Agent Output] ---\n"
+    )
+
+def _format_tool_calls(tool_calls: list) -> str:
+    lines = ["-> Tool Calls Required:\n"]
+    lines.extend(f"  - Function: {name}, Args: {args}\n" for name, args in tool_calls)
+    return "".join(lines)
+
+def _format_answer_intro(tool_calls: list) -> str:
+    # Check for Tool Calls
+    if tool_calls:
+        return _format_tool_calls(tool_calls) + "\n[Final Answer]: (Model Response after tool indication)\n\n"
+    return "-> Handled by Instruction Only (No tool required)\n\n"
+
+def _print_output(query: str, agent_key: str, tool_calls: list, text: str, out: TextIO | None = None):
+    """Writes the routed query, any requested tool calls and the final answer in one write."""
+    out = out or sys.stdout
+    out.write(_format_header(query, agent_key) + _format_answer_intro(tool_calls) + f"{text}\n----------------------\n")
+
+async def call_agent_and_print(query: str, out: TextIO | None = None):
+    """
+    Sends a query to the model using the determined specialized instruction.
+    Output is written to 'out' (stdout by default); pass a StringIO to keep
+    concurrent runs readable. Returns the AgentRoute, or None on failure.
+    """
+    out = out or sys.stdout
+    # 1. Determine the Agent (Route the query locally)
     agent_key = determine_agent(query)
-    instruction = INSTRUCTION_MAP[agent_key]
-    
-    print(f"\n[User Query] -> {query}")
-    print(f"[Agent Routed To] -> {agent_key}")
-    print("----------------------")
 
-    # 2. Execute the Call with the specific Instruction and Tools
+    # 2. Execute the Call
+    if agent_key == "PlannerAgent":
+        return await _run_fused(query, out)
+    return await _run_specialist(query, agent_key, out)
+
+async def _run_specialist(query: str, agent_key: str, out: TextIO):
+    """
+    Runs the query under a single specialist instruction with the tools enabled.
+    The answer is streamed to 'out' as it is generated, in the _print_output layout.
+    Function calls usually precede the text; any that arrive after the answer has
+    started are listed at its end.
+    """
+    start = time.perf_counter()
     try:
-        # Use the specific instruction as the system prompt for the main call
-        response = client.models.generate_content(
-            model='gemini-2.5-pro' if agent_key == "CreativeAgent" else 'gemini-2.5-flash', # Use Pro for creative tasks
-            contents=[instruction, query],
-            config=types.GenerateContentConfig(
-                tools=TOOL_FUNCTIONS,
-                system_instruction=instruction,
-            )
-        )
+        # The agent instruction travels once, as the system prompt in _CONFIGS.
+        # Only opening the stream is retried; the limiter slot is held until the
+        # whole answer has been received.
+        (first, stream), token = await _call_with_retry(functools.partial(_open_stream, agent_key, query), hold_slot=True)
+        tool_calls = []
+        text = []
+        # Number of tool calls listed before the answer; None until the answer starts
+        shown = None
+        try:
+            out.write(_format_header(query, agent_key))
+            async for chunk in _chain(first, stream):
+                # Function calls may arrive in any chunk, so collect them as we go
+                for call in chunk.function_calls or ():
+                    # call.args is already a dict; keep a reference rather than copying it
+                    tool_calls.append((call.name, call.args or {}))
+                    LOG.debug("tool_call %s", call.name, extra={"tool_name": call.name, "tool_args": call.args})
+                if chunk.text:
+                    if shown is None:
+                        out.write(_format_answer_intro(tool_calls))
+                        shown = len(tool_calls)
+                    text.append(chunk.text)
+                    out.write(chunk.text)
+                    out.flush()
+        except BaseException as e:
+            # Close off the partial output so the next result starts cleanly
+            out.write("\n[Output interrupted]\n----------------------\n")
+            await _get_limiter().release(token, e)
+            raise
+        await _get_limiter().release(token)
+        tail = [_format_answer_intro(tool_calls)] if shown is None else []
+        tail.append("\n")
+        if shown is not None and len(tool_calls) > shown:
+            tail.append(_format_tool_calls(tool_calls[shown:]))
+        tail.append("----------------------\n")
+        out.write("".join(tail))
+        return AgentRoute(query, agent_key, tuple(tool_calls), "".join(text), (time.perf_counter() - start) * 1000)
+
+    except APIError as e:
+        LOG.error("API Call failed for %s: %s", agent_key, e)
+    except Exception as e:
+        LOG.error("An unexpected error occurred: %s", e)
+
+async def _open_stream(agent_key: str, query: str):
+    """
+    Starts a streamed specialist call and waits for its first chunk. The request is
+    only sent once the stream is iterated, so this is where API errors surface (and
+    can still be retried, since nothing has been printed yet).
+    """
+    stream = await get_client().aio.models.generate_content_stream(
+        model=_MODEL_FOR[agent_key],
+        contents=[query],
+        config=_CONFIGS[agent_key],
+    )
+    return await anext(stream, None), stream
 
-        # 3. Print Output
-        print("\n--- [Agent Output] ---")
-        
-        # Check for Tool Calls
-        if response.function_calls:
-            print("-> Tool Calls Required:")
-            for call in response.function_calls:
-                print(f"  - Function: {call.name}, Args: {dict(call.args)}")
-            print("\n[Final Answer]: (Model Response after tool indication)")
-        else:
-            print("-> Handled by Instruction Only (No tool required)")
-        
-        print(f"\n{response.text}")
-        print("----------------------")
+async def _chain(first, stream):
+    if first is not None:
+        yield first
+    async for chunk in stream:
+        yield chunk
 
+async def _run_fused(query: str, out: TextIO):
+    """Performs the fused routing + execution call and prints the result."""
+    start = time.perf_counter()
+    try:
+        response = await _call_with_retry(functools.partial(
+            get_client().aio.models.generate_content,
+            model=_ROUTER_MODEL,
+            contents=[query],
+            config=_ROUTER_CONFIG,
+        ))
+        result = _json_loads(response.text)
+        if not isinstance(result, dict):
+            raise ValueError(f"expected a JSON object, got {type(result).__name__}")
     except APIError as e:
-        print(f"\n[Execution Error] API Call failed for {agent_key}: {e}")
+        LOG.error("API Call failed for query %r: %s", query, e)
+        return
+    except (ValueError, TypeError) as e:
+        LOG.error("Could not parse the model response for %r: %s", query, e)
+        return
+    except Exception as e:
+        LOG.error("An unexpected error occurred: %s", e)
+        return
+
+    agent_key = _accept_route(query, result.get("agent_key", ""))
+    tool_calls = _parse_tool_calls(result.get("tool_calls"))
+    route = AgentRoute(query, agent_key, tool_calls, _answer_text(result.get("answer")), (time.perf_counter() - start) * 1000)
+    _print_output(route.query, route.agent_key, route.tool_calls, route.text, out)
+    return route
+
+def _parse_tool_calls(calls) -> tuple[tuple[str, dict], ...]:
+    """
+    Converts the schema's tool_calls list to (name, args) pairs, skipping malformed
+    entries. The JSON-encoded args are decoded so they match streamed function calls.
+    """
+    if not isinstance(calls, list):
+        return ()
+    return tuple(
+        (call["name"], _parse_tool_args(call.get("args")))
+        for call in calls
+        if isinstance(call, dict) and isinstance(call.get("name"), str)
+    )
+
+def _parse_tool_args(args) -> dict:
+    if isinstance(args, dict):
+        return args
+    if not isinstance(args, str) or not args.strip():
+        return {}
+    try:
+        decoded = _json_loads(args)
+    except ValueError:
+        decoded = None
+    # Keep undecodable args visible rather than dropping them
+    return decoded if isinstance(decoded, dict) else {"raw": args}
+
+def _answer_text(answer) -> str:
+    """Coerces the model's 'answer' field to text; a missing or null answer becomes empty."""
+    if answer is None:
+        return ""
+    return answer if isinstance(answer, str) else str(answer)
+
+def _accept_route(query: str, agent_key) -> str:
+    """Validates the agent key picked by the model and records it for the query."""
+    if not isinstance(agent_key, str) or agent_key not in _KEY_SET:
+        # Fallback if the model gives a bad answer
+        LOG.warning("Model returned invalid key: %s", agent_key)
+        agent_key = "PlannerAgent"
+    remember_route(query, agent_key)
+    return agent_key
+
+async def run_batch(queries: list[str]) -> list[AgentRoute]:
+    """
+    Answers all queries with a single fused call returning a JSON array.
+    Each query carries its locally routed key as a hint. Returns one AgentRoute per
+    query the model answered, in input order; latency_ms is that of the whole batch.
+    """
+    numbered = "\n".join(f"{i}) [{determine_agent(q)}] {q}" for i, q in enumerate(queries, 1))
+    prompt = f"""
+    For each numbered query below, output one JSON object with its 'index', 'agent_key', 
+    'answer' and 'tool_calls'. The bracketed key is the suggested instruction key; keep it 
+    unless it is 'PlannerAgent', in which case choose the best key yourself.
+
+    Queries:
+{numbered}
+    """
+    start = time.perf_counter()
+    response = await _call_with_retry(functools.partial(
+        get_client().aio.models.generate_content,
+        model=_ROUTER_MODEL,
+        contents=[prompt],
+        config=_BATCH_CONFIG,
+    ))
+    latency_ms = (time.perf_counter() - start) * 1000
+    items = _json_loads(response.text)
+    if not isinstance(items, list):
+        raise ValueError(f"expected a JSON array, got {type(items).__name__}")
+    # Entries without a usable index can't be matched to a query; those queries
+    # are simply left for the per-query fallback.
+    answers = {item.get("index"): item for item in items if isinstance(item, dict)}
+
+    results = []
+    for i, query in enumerate(queries, 1):
+        item = answers.get(i)
+        if item is None:
+            continue
+        results.append(AgentRoute(
+            query,
+            _accept_route(query, item.get("agent_key", "")),
+            _parse_tool_calls(item.get("tool_calls")),
+            _answer_text(item.get("answer")),
+            latency_ms,
+        ))
+    return results
+
+# Test queries designed to hit various agents, including the Planner
+TEST_QUERIES = [
+    "What is the capital city of Pakistan?", # 1. Simple, handled by PlannerAgent (as a safe default)
+    "Write a Python script to calculate the factorial of number 7 and execute it.", # 2. CodingAgent
+    "What are the common symptoms and initial treatment for Parvovirus in puppies?", # 3. VeterinaryKBAgent
+    "First, summarize the article at https://en.wikipedia.org/wiki/Veterinary_medicine, and then run a Python script to print the word 'Veterinarian'.", # 4. PlannerAgent (Multi-step)
+    "How is the open-source tool Aircrack-ng ethically used by security professionals to test WiFi security?", # 5. NetSecAgent
+    "What are the security best practices for setting up SSH access through a gateway server?", # 6. RemoteAccessAgent
+    "Suggest three creative concepts for a social media campaign promoting a free Parvovirus screening camp.", # 7. CreativeAgent
+    "Explain the purpose of BitLocker and how it protects data on a Windows system.", # 8. SystemSecurityAgent
+    "What are the advantages of using smart motion sensors alongside IP cameras for home security?", # 9. MonitoringAgent
+    "Provide guidance on using server-side receipt validation to prevent subscription fraud in mobile apps.", # 10. SubscriptionAgent
+    "How can I use an RTL-SDR dongle and GNU Radio to capture and analyze FM radio signals?", # 11. RFSpyAgent
+    "Describe how the VLC player can be used to decode DVB-T streams for analysis.", # 12. DigitalMediaAgent
+    "Explain how the Lynis tool can improve self-security auditing on a Linux system.", # 13. PolyAgent
+]
+
+async def _call_buffered(query: str):
+    """Runs one query into its own buffer and writes it out in one piece when done."""
+    buf = io.StringIO()
+    result = await call_agent_and_print(query, out=buf)
+    sys.stdout.write(buf.getvalue())
+    sys.stdout.flush()
+    return result
+
+async def warm_up():
+    """
+    Opens a pooled connection with a cheap metadata request (no tokens generated),
+    so the first of a burst of concurrent calls does not pay DNS+TCP+TLS setup while
+    the rest queue behind it. Failures are ignored; the real calls will surface any problem.
+    """
+    try:
+        await get_client().aio.models.get(model=_ROUTER_MODEL)
     except Exception as e:
-        print(f"\n[Execution Error] An unexpected error occurred: {e}")
+        LOG.debug("Connection warm-up failed: %s", e)
+
+async def serve(queries: list[str]) -> list[AgentRoute]:
+    """
+    Answers the queries, prints each result and returns the AgentRoutes in input order.
+    The Gemini client and its connection pool are kept per event loop, so callers
+    that keep one loop alive and call serve() repeatedly on it reuse warm
+    connections instead of paying the TCP+TLS handshakes again:
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(serve(first_batch))
+        loop.run_until_complete(serve(second_batch))
+        loop.run_until_complete(close_client())
+
+    Separate asyncio.run(serve(...)) calls also work, each on a fresh client.
+    """
+    # All queries go out in one batched call. Any the model skipped (or the whole
+    # set, if the batch fails) fall back to concurrent per-query calls.
+    try:
+        results = await run_batch(queries)
+    except (APIError, ValueError, TypeError) as e:
+        LOG.warning("Batched call failed, falling back to per-query calls: %s", e)
+        results = []
+
+    for result in results:
+        _print_output(result.query, result.agent_key, result.tool_calls, result.text)
+
+    answered = {result.query for result in results}
+    remaining = [q for q in queries if q not in answered]
+    try:
+        if remaining:
+            # A single batched call gains nothing from warming up; the fallback burst does
+            await warm_up()
+        results.extend(r for r in await asyncio.gather(*(_call_buffered(q) for q in remaining)) if r)
+    finally:
+        save_route_cache()
+
+    order = {query: i for i, query in enumerate(queries)}
+    results.sort(key=lambda result: order[result.query])
+    return results
+
+def _setup_logging() -> None:
+    # main() may run more than once in a process; add the handler only once
+    if not LOG.handlers:
+        h = logging.StreamHandler(sys.stdout)
+        fmt = "%(asctime)s %(levelname)s %(message)s"
+        h.setFormatter(logging.Formatter(fmt))
+        LOG.addHandler(h)
+    LOG.setLevel(logging.INFO)
 
 async def main():
     """Runs the test queries."""
+    _setup_logging()
+    try:
+        get_client()
+    except Exception as e:
+        LOG.critical("Error initializing Gemini Client. Ensure GEMINI_API_KEY is set correctly. Error: %s", e)
+        return
     
     print("--- Multi-Agent System V2 Initialized (Using google-genai SDK) ---")
     print(f"Total Specialized Instructions/Agents: {len(INSTRUCTION_MAP)}")
     print("-----------------------------------------------------------------")
     
-    # Test queries designed to hit various agents, including the Planner
-    test_queries = [
-        "What is the capital city of Pakistan?", # 1. Simple, handled by PlannerAgent (as a safe default)
-        "Write a Python script to calculate the factorial of number 7 and execute it.", # 2. CodingAgent
-        "What are the common symptoms and initial treatment for Parvovirus in puppies?", # 3. VeterinaryKBAgent
-        "First, summarize the article at https://en.wikipedia.org/wiki/Veterinary_medicine, and then run a Python script to print the word 'Veterinarian'.", # 4. PlannerAgent (Multi-step)
-        "How is the open-source tool Aircrack-ng ethically used by security professionals to test WiFi security?", # 5. NetSecAgent
-        "What are the security best practices for setting up SSH access through a gateway server?", # 6. RemoteAccessAgent
-        "Suggest three creative concepts for a social media campaign promoting a free Parvovirus screening camp.", # 7. CreativeAgent
-        "Explain the purpose of BitLocker and how it protects data on a Windows system.", # 8. SystemSecurityAgent
-        "What are the advantages of using smart motion sensors alongside IP cameras for home security?", # 9. MonitoringAgent
-        "Provide guidance on using server-side receipt validation to prevent subscription fraud in mobile apps.", # 10. SubscriptionAgent
-        "How can I use an RTL-SDR dongle and GNU Radio to capture and analyze FM radio signals?", # 11. RFSpyAgent
-        "Describe how the VLC player can be used to decode DVB-T streams for analysis.", # 12. DigitalMediaAgent
-        "Explain how the Lynis tool can improve self-security auditing on a Linux system.", # 13. PolyAgent
-    ]
-    
-    for query in test_queries:
-        await call_agent_and_print(query)
-        
+    try:
+        await serve(TEST_QUERIES)
+    finally:
+        await close_client()
+
     print("\n--- ALL TESTS COMPLETE ---")
 
 if __name__ == '__main__':
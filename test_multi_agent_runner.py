@@ -0,0 +1,188 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import pytest
+from google.genai.errors import APIError
+
+import multi_agent_runner as m
+
+
+def _api_error(code: int) -> APIError:
+    return APIError(code, {"error": {"code": code, "message": "test", "status": "TEST"}})
+
+
+class FakeStreamClient:
+    """Stands in for genai.Client: streams a few chunks and tracks open streams."""
+
+    def __init__(self, chunks=None, fail_after=None):
+        self.chunks = chunks or [SimpleNamespace(text=word, function_calls=None) for word in ("one ", "two ", "three")]
+        self.fail_after = fail_after
+        self.open = 0
+        self.peak = 0
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content_stream=self.generate_content_stream))
+
+    async def generate_content_stream(self, **kwargs):
+        return self._stream()
+
+    async def _stream(self):
+        # Like the SDK, the request only goes out once the stream is iterated
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+        try:
+            for i, chunk in enumerate(self.chunks):
+                if i == self.fail_after:
+                    raise _api_error(500)
+                await asyncio.sleep(0.01)
+                yield chunk
+        finally:
+            self.open -= 1
+
+
+# --- Local routing ---
+
+ROUTING_CASES = list(zip(m.TEST_QUERIES, [
+    "PlannerAgent",
+    "CodingAgent",
+    "VeterinaryKBAgent",
+    "PlannerAgent",
+    "NetSecAgent",
+    "RemoteAccessAgent",
+    "CreativeAgent",
+    "SystemSecurityAgent",
+    "MonitoringAgent",
+    "SubscriptionAgent",
+    "RFSpyAgent",
+    "DigitalMediaAgent",
+    "PolyAgent",
+])) + [
+    # A single step marker is not a multi-step request
+    ("What is the first step to secure SSH?", "RemoteAccessAgent"),
+    ("Finally, recommend a VPN for remote work.", "RemoteAccessAgent"),
+    ("How do I secure my IP cameras at home?", "MonitoringAgent"),
+    ("How do I enable BitLocker on Windows 11?", "SystemSecurityAgent"),
+    ("First scan the network with Nmap, then write a report.", "PlannerAgent"),
+]
+
+
+@pytest.mark.parametrize("query, expected", ROUTING_CASES)
+def test_classify(query, expected):
+    assert m._classify(query) == expected
+
+
+# --- Output ---
+
+def _call(name, args):
+    return SimpleNamespace(name=name, args=args)
+
+
+@pytest.mark.parametrize("calls", [[], [_call("google_search", {"query": "ssh"})]])
+def test_streamed_output_matches_print_output(monkeypatch, calls):
+    chunks = [SimpleNamespace(text=None, function_calls=calls)] + [
+        SimpleNamespace(text=word, function_calls=None) for word in ("one ", "two")
+    ]
+    monkeypatch.setattr(m, "get_client", lambda: FakeStreamClient(chunks))
+    streamed = io.StringIO()
+    route = asyncio.run(m._run_specialist("q", "NetSecAgent", streamed))
+    printed = io.StringIO()
+    m._print_output(route.query, route.agent_key, route.tool_calls, route.text, printed)
+    assert streamed.getvalue() == printed.getvalue()
+
+
+def test_interrupted_stream_is_terminated(monkeypatch):
+    monkeypatch.setattr(m, "get_client", lambda: FakeStreamClient(fail_after=2))
+    out = io.StringIO()
+    assert asyncio.run(m._run_specialist("q", "CodingAgent", out)) is None
+    assert out.getvalue().endswith("one two \n[Output interrupted]\n----------------------\n")
+
+
+# --- Limiter and retries ---
+
+def test_limit_caps_concurrent_streams(monkeypatch):
+    monkeypatch.setattr(m, "MAX_CONCURRENT_CALLS", 2)
+    client = FakeStreamClient()
+    monkeypatch.setattr(m, "get_client", lambda: client)
+
+    async def run():
+        return await asyncio.gather(*(m._run_specialist(f"q{i}", "CodingAgent", io.StringIO()) for i in range(10)))
+
+    routes = asyncio.run(run())
+    assert all(route.text == "one two three" for route in routes)
+    assert client.peak == 2
+
+
+def test_burst_of_429s_cuts_limit_once(monkeypatch):
+    monkeypatch.setattr(m, "RETRY_ATTEMPTS", 1)
+
+    async def run():
+        limiter = m._get_limiter()
+        started = 0
+        all_started = asyncio.Event()
+
+        async def rate_limited():
+            nonlocal started
+            started += 1
+            if started == m.MAX_CONCURRENT_CALLS:
+                all_started.set()
+            await all_started.wait()
+            raise _api_error(429)
+
+        results = await asyncio.gather(
+            *(m._call_with_retry(rate_limited) for _ in range(m.MAX_CONCURRENT_CALLS)), return_exceptions=True
+        )
+        assert all(isinstance(r, APIError) and r.code == 429 for r in results)
+        return limiter.limit
+
+    assert m.MAX_CONCURRENT_CALLS == 8
+    assert asyncio.run(run()) == 4
+
+
+def test_successive_event_loops(monkeypatch):
+    monkeypatch.setattr(m, "MAX_CONCURRENT_CALLS", 1)
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+
+    async def run():
+        async def call():
+            await asyncio.sleep(0.001)
+            return "ok"
+
+        # Limit 1 makes the calls wait on the limiter's condition
+        results = await asyncio.gather(*(m._call_with_retry(call) for _ in range(3)))
+        client = m.get_client()
+        assert m.get_client() is client
+        await m.close_client()
+        return results, client
+
+    first, first_client = asyncio.run(run())
+    second, second_client = asyncio.run(run())
+    assert first == second == ["ok"] * 3
+    assert first_client is not second_client
+
+
+@pytest.mark.parametrize("code", [400, 403, 404])
+def test_non_retryable_errors_raise_immediately(monkeypatch, code):
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        raise _api_error(code)
+
+    with pytest.raises(APIError):
+        asyncio.run(m._call_with_retry(failing))
+    assert calls == 1
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(m, "RETRY_BASE_DELAY", 0.0)
+    calls = 0
+
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise _api_error(503)
+        return "ok"
+
+    assert asyncio.run(m._call_with_retry(flaky)) == "ok"
+    assert calls == 2